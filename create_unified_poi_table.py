@@ -2,13 +2,27 @@
 import osmnx as ox # to fetch data from OpenStreetMap
 import geopandas as gpd # to work with geospatial data
 import pandas as pd
+import numpy as np
+from scipy.spatial import cKDTree # vectorized nearest-neighbour lookups
 from sqlalchemy import create_engine, text
 import warnings
 import json
+import uuid
+import io
+import os
+import argparse
 
 
 warnings.filterwarnings("ignore")
 
+# Command line options
+parser = argparse.ArgumentParser(description='Build the unified_pois table from the source data layers')
+parser.add_argument('--rebuild', action='store_true',
+                    help='Drop unified_pois and processed_tables_log and rebuild from scratch instead of only adding new tables')
+parser.add_argument('--sql-knn', action='store_true',
+                    help='Compute nearest POIs with in-database KNN instead of the Python KD-tree')
+args = parser.parse_args()
+
 # Credentials
 user_name=''
 password=''
@@ -18,26 +32,30 @@ host = 'localhost'
 port = '5433'
 database = 'layereddb'
 schema='berlin_source_data'
+use_python_knn = not args.sql_knn       # KD-tree in Python (one vectorized query per layer) unless --sql-knn asks for per-row KNN in PostgreSQL
 
 # Connection to DB
 engine = create_engine(f'postgresql+psycopg2://{user_name}:{password}@{host}:{port}/{database}')
 
 with engine.begin() as conn:
 # Step 1: Validation query for excluded tables
+    required_columns = ['id', 'name', 'district_id', 'district', 'latitude',
+                        'longitude', 'neighborhood_id', 'neighborhood', 'geometry']                                          # Columns every source table must have
+
     validation_query = """
         DROP TABLE IF EXISTS excluded_tables_log CASCADE;
 
         -- Create the excluded_tables_log table
         CREATE TABLE public.excluded_tables_log (           -- Adding to public schema for now
             table_name VARCHAR(255),
-            reason VARCHAR(500),
+            reason TEXT,                                    -- One aggregated reason per check can list many columns, so no length cap
             exclusion_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
 
         WITH all_tables AS (
             SELECT table_name
             FROM information_schema.tables
-            WHERE table_schema = 'berlin_source_data'
+            WHERE table_schema = :schema
             AND table_name NOT ILIKE '%districts%'          -- Must not be included in final table so doesnt need to be checked
             AND table_name NOT ILIKE '%neighborhoods%'      -- Must not be included in final table so doesnt need to be checked
         ),
@@ -54,103 +72,91 @@ with engine.begin() as conn:
                 ('neighborhood_id', 'character varying', NULL, NULL, 'YES')
             ) AS t(column_name, expected_type, expected_length, constraint_type, is_nullable)
         ),
-        -- Checks all columns exist
-        missing_columns AS (
-            SELECT tc.table_name,
-                STRING_AGG(DISTINCT col, ', ' ORDER BY col) AS missing_cols
-            FROM all_tables tc
-            CROSS JOIN (VALUES 
-                ('id'), ('name'), ('district_id'), ('district'),
-                ('latitude'), ('longitude'), ('neighborhood_id'),
-                ('neighborhood'), ('geometry')
-            ) AS req_cols(col)
-            LEFT JOIN information_schema.columns c 
-                ON tc.table_name = c.table_name 
-                AND c.table_schema = 'berlin_source_data'
-                AND LOWER(c.column_name) = req_cols.col
-            WHERE c.column_name IS NULL
-            GROUP BY tc.table_name
-            HAVING COUNT(*) > 0
-        ),
-        -- Checks all data types correct and creates and adds an error to the excluded_tables_log table when incorrect
-        datatype_issues AS (
-            SELECT 
-                c.table_name,
-                'Expected data type ' || e.expected_type || ', got ' || c.data_type AS reason
-            FROM information_schema.columns c
-            JOIN expected_schema e 
-                ON LOWER(c.column_name) = e.column_name
-            WHERE c.table_schema = 'berlin_source_data'
-            AND (
-                    c.data_type <> e.expected_type
-                    OR (c.data_type = 'numeric' AND (c.numeric_precision || ',' || c.numeric_scale) <> e.expected_length)
-            )
-        ),
-        -- Checks all columns that cannot contain NULL are correct and adds an error to the excluded_tables_log table when incorrect
-        null_issues AS (
-            SELECT c.table_name,
-                'Column ' || c.column_name || ' allows NULL, expected NOT NULL' AS reason
-            FROM information_schema.columns c
-            JOIN expected_schema e 
-                ON LOWER(c.column_name) = e.column_name
-            WHERE c.table_schema = 'berlin_source_data'
-            AND e.is_nullable = 'NO'
-            AND c.is_nullable = 'YES'
-        ),
-        -- Checks primary key on id column and creates and adds an error to the excluded_tables_log table when incorrect
-        pk_issues AS (
-            SELECT t.table_name,
-                'Missing PRIMARY KEY on id column' AS reason
-            FROM all_tables t
-            WHERE NOT EXISTS (
-                SELECT 1
-                FROM information_schema.table_constraints tc
-                JOIN information_schema.key_column_usage kcu
-                    ON kcu.constraint_name = tc.constraint_name
-                    AND kcu.table_name = tc.table_name
-                WHERE tc.table_schema = 'berlin_source_data'
-                AND tc.table_name = t.table_name
-                AND tc.constraint_type = 'PRIMARY KEY'
-                AND LOWER(kcu.column_name) = 'id'
-            )
-        ),
-        -- Checks foreign key on district_id column and creates and adds an error to the excluded_tables_log table when incorrect
-        fk_issues AS (
-            SELECT t.table_name,
-                'Missing or incorrect foreign key on district_id' AS reason
-            FROM all_tables t
-            WHERE NOT EXISTS (
-                SELECT 1
-                FROM information_schema.table_constraints tc
-                WHERE tc.table_schema = 'berlin_source_data'
-                AND tc.table_name = t.table_name
-                AND tc.constraint_type = 'FOREIGN KEY'
-            )
-        ),
-        -- Combines all invalid tables into one
+        -- All checks evaluated per table in one pass; a check that passes yields NULL and is dropped by the join condition
         invalid_tables AS (
-            SELECT table_name, 'Missing columns: ' || missing_cols AS reason FROM missing_columns
-            UNION ALL SELECT table_name, reason FROM datatype_issues
-            UNION ALL SELECT table_name, reason FROM null_issues
-            UNION ALL SELECT table_name, reason FROM pk_issues
-            UNION ALL SELECT table_name, reason FROM fk_issues
+            SELECT t.table_name, r.reason
+            FROM all_tables t
+            JOIN LATERAL (VALUES
+                -- Checks all columns exist
+                ((SELECT 'Missing columns: ' || STRING_AGG(req_cols.col, ', ' ORDER BY req_cols.col)
+                  FROM unnest(CAST(:req_cols AS text[])) AS req_cols(col)
+                  WHERE NOT EXISTS (
+                      SELECT 1 FROM information_schema.columns c
+                      WHERE c.table_schema = :schema
+                      AND c.table_name = t.table_name
+                      AND LOWER(c.column_name) = req_cols.col
+                  ))),
+                -- Checks all data types correct
+                ((SELECT STRING_AGG('Expected data type ' || e.expected_type || ', got ' || c.data_type, '; ')
+                  FROM information_schema.columns c
+                  JOIN expected_schema e
+                      ON LOWER(c.column_name) = e.column_name
+                  WHERE c.table_schema = :schema
+                  AND c.table_name = t.table_name
+                  AND (
+                          c.data_type <> e.expected_type
+                          OR (c.data_type = 'numeric' AND (c.numeric_precision || ',' || c.numeric_scale) <> e.expected_length)
+                  ))),
+                -- Checks all columns that cannot contain NULL are correct
+                ((SELECT STRING_AGG('Column ' || c.column_name || ' allows NULL, expected NOT NULL', '; ')
+                  FROM information_schema.columns c
+                  JOIN expected_schema e
+                      ON LOWER(c.column_name) = e.column_name
+                  WHERE c.table_schema = :schema
+                  AND c.table_name = t.table_name
+                  AND e.is_nullable = 'NO'
+                  AND c.is_nullable = 'YES')),
+                -- Checks primary key on id column
+                ((SELECT 'Missing PRIMARY KEY on id column'
+                  WHERE NOT EXISTS (
+                      SELECT 1
+                      FROM information_schema.table_constraints tc
+                      JOIN information_schema.key_column_usage kcu
+                          ON kcu.constraint_name = tc.constraint_name
+                          AND kcu.table_name = tc.table_name
+                      WHERE tc.table_schema = :schema
+                      AND tc.table_name = t.table_name
+                      AND tc.constraint_type = 'PRIMARY KEY'
+                      AND LOWER(kcu.column_name) = 'id'
+                  ))),
+                -- Checks foreign key on district_id column
+                ((SELECT 'Missing or incorrect foreign key on district_id'
+                  WHERE NOT EXISTS (
+                      SELECT 1
+                      FROM information_schema.table_constraints tc
+                      WHERE tc.table_schema = :schema
+                      AND tc.table_name = t.table_name
+                      AND tc.constraint_type = 'FOREIGN KEY'
+                  ))),
+                -- Checks the geometry column already carries SRID 4326 so the pipeline never has to re-parse geometries
+                ((SELECT 'Geometry SRID ' || g.srid || ', expected 4326'
+                  FROM geometry_columns g
+                  WHERE g.f_table_schema = :schema
+                  AND g.f_table_name = t.table_name
+                  AND g.srid NOT IN (0, 4326)
+                  LIMIT 1))
+            ) r(reason) ON r.reason IS NOT NULL
         )
         -- Inserts all invalid tables into excluded_tables_log
         INSERT INTO excluded_tables_log (table_name, reason)
         SELECT table_name, reason FROM invalid_tables;
 """
 
-    conn.execute(text(validation_query))
+    conn.execute(text(validation_query), {"schema": schema, "req_cols": required_columns})                                   # Invariant statement text so the plan can be cached across runs
     print("✅ Validation query complete")
 
-# Step 2: Drop unified_pois and processed_tables_log if they exist, then create them again from scratch
+# Step 2: Create unified_pois and processed_tables_log if missing; only drop them first on an explicit --rebuild
 
-    conn.execute(text("DROP TABLE IF EXISTS unified_pois CASCADE;"))
-    conn.execute(text("DROP TABLE IF EXISTS processed_tables_log CASCADE;"))
+    if args.rebuild:
+        conn.execute(text("""
+            DROP TABLE IF EXISTS unified_pois CASCADE;
+            DROP TABLE IF EXISTS processed_tables_log CASCADE;
+        """))
 
-    conn.execute(text("""
+    conn.execute(text("""                                                                                                   -- One round-trip for all the setup DDL instead of four
         CREATE TABLE IF NOT EXISTS public.unified_pois (                                                                    -- Adding to public schema for now
-            poi_id VARCHAR(50) PRIMARY KEY,
+            poi_id BIGINT PRIMARY KEY,                                                                                      -- 8-byte surrogate key keeps the PK index small and comparisons cheap
+            source_id VARCHAR(50),                                                                                          -- Original '<prefix>-<id>' kept for joining back to the source tables
             name VARCHAR(200),
             layer VARCHAR(100),
             district_id VARCHAR(20),
@@ -159,118 +165,266 @@ with engine.begin() as conn:
             neighborhood VARCHAR(100),
             latitude DECIMAL(9,6),
             longitude DECIMAL(9,6),
-            geometry GEOMETRY, 
+            geometry GEOMETRY,
             attributes JSONB,
             nearest_pois JSONB
         );
-    """))
-    conn.execute(text("""                                                                                                   
+
         CREATE TABLE IF NOT EXISTS public.processed_tables_log (                                                            -- Adding to public schema for now (Creates log of processed tables)
             table_name VARCHAR(255) PRIMARY KEY,
             processed_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
+
+        CREATE TABLE IF NOT EXISTS public.query_plans (                                                                     -- Keeps one EXPLAIN plan per run so hot spots can be compared over time
+            run_id VARCHAR(36),
+            statement VARCHAR(50),
+            plan JSONB,
+            captured_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
     """))
     print("✅ Unified table and log table ready")
 
     # Step 3: Get new tables to process
+    poi_tables = [t.strip() for t in os.environ.get(
+        'POI_TABLES', 'galleries,food_markets,long_term_listings,banks,malls').split(',') if t.strip()] or None             # Comma-separated allow-list for testing; set POI_TABLES= (empty) to process every valid table
+
     valid_tables_sql = """
         SELECT table_name
         FROM information_schema.tables
-        WHERE table_schema = 'berlin_source_data'
-            AND table_name NOT ILIKE '%districts%'                                                                          -- doesn't need to be included in final table
-            AND table_name NOT ILIKE '%neighborhoods%'                                                                      -- doesn't need to be included in final table
+        WHERE table_schema = %(schema)s
+            AND table_name NOT ILIKE '%%districts%%'                                                                        -- doesn't need to be included in final table
+            AND table_name NOT ILIKE '%%neighborhoods%%'                                                                    -- doesn't need to be included in final table
             AND table_name NOT IN (SELECT table_name FROM excluded_tables_log)                                              -- Exclude invalid tables
-            AND table_name IN ('galleries', 'food_markets','long_term_listings', 'banks', 'malls')                          -- This line is just for testing purposes so can load a few tables at a time , 'bike_lanes'
+            AND table_name NOT IN (SELECT table_name FROM processed_tables_log)                                             -- Skip tables already in unified_pois so runs are incremental
+            AND (CAST(%(tables)s AS text[]) IS NULL OR table_name = ANY(%(tables)s))                                        -- Same prepared statement regardless of the allow-list
     ;
     """
 
-    new_tables = [row[0] for row in conn.execute(text(valid_tables_sql))]                                                    # Get list of tables to process
+    discover_cur = conn.connection.cursor(name='discover_tables')                                                           # Server-side cursor streams rows instead of buffering them all client-side
+    discover_cur.itersize = 1000
+    discover_cur.execute(valid_tables_sql, {"schema": schema, "tables": poi_tables})
+    new_tables = [row[0] for row in discover_cur]                                                                            # Get list of tables to process
+    discover_cur.close()
     print(f"✅ New tables to process: {new_tables}")
 
     # Step 4: Insert only new tables
     if new_tables:
-        union_queries = []                                                                                                   # Reset union_queries for new tables
+        conn.execute(text("""
+            CREATE TEMP TABLE all_pois_stage (                                                                               -- Staging table so the planner sees one relation instead of an N-branch UNION ALL
+                poi_id BIGINT,
+                source_id VARCHAR(50),
+                name VARCHAR(200),
+                layer VARCHAR(100),
+                district_id VARCHAR(20),
+                district VARCHAR(100),
+                neighborhood_id VARCHAR(20),
+                neighborhood VARCHAR(100),
+                latitude DECIMAL(9,6),
+                longitude DECIMAL(9,6),
+                geometry GEOMETRY,
+                attributes JSONB,
+                nearest_pois JSONB
+            ) ON COMMIT DROP;
+        """))
+
         for table in new_tables:
-            union_queries.append(f"""
-                SELECT 
-                    CONCAT(SUBSTRING('{table}' FROM 1 FOR 4), '-', t.id) AS poi_id,                                          -- Unique poi_id created so no duplicates can happen in error
-                    t.name,
-                    '{table}' AS layer,
-                    t.district_id,
-                    t.district,
-                    t.neighborhood_id,
-                    t.neighborhood,
-                    t.latitude,
-                    t.longitude,
-                    ST_SetSRID(ST_GeomFromEWKT(t.geometry), 4326) AS geometry,                                                -- Ensure geometry is in correct SRID
-                    (to_jsonb(t) - 'id' - 'name' - 'district_id' - 'neighborhood_id' - 'latitude' - 'longitude' - 'geometry') AS attributes     -- All other columns as attributes in JSONB
-                FROM berlin_source_data.{table} t
-            """)
-        union_sql = " UNION ALL ".join(union_queries)                                                                          # Combine all SELECTs into one UNION ALL query (one for each valid table)
-
-        insert_sql = f"""
-            WITH all_pois AS (
-                {union_sql}
-            ),
-            unique_layers AS (
-                SELECT DISTINCT layer FROM all_pois WHERE layer <> 'long_term_listings'                                          -- Won't add the listing itself to the nearest_pois json doc
+            conn.execute(text(f"""
+                INSERT INTO all_pois_stage
+                    (poi_id, source_id, name, layer, district_id, district, neighborhood_id, neighborhood,
+                     latitude, longitude, geometry, attributes)
+                SELECT
+                    hashtextextended(q.source_id, 0) AS poi_id,                                                               -- 64-bit hash of the textual id as surrogate key
+                    q.source_id,
+                    q.name,
+                    q.layer,
+                    q.district_id,
+                    q.district,
+                    q.neighborhood_id,
+                    q.neighborhood,
+                    ST_Y(ST_Centroid(q.geometry)) AS latitude,                                                                -- Derive lat/lon from geometry once instead of shipping the redundant source columns;
+                    ST_X(ST_Centroid(q.geometry)) AS longitude,                                                               -- centroid is a no-op for points but keeps line/polygon layers like bike_lanes loadable
+                    q.geometry,
+                    q.attributes
+                FROM (
+                    SELECT
+                        CONCAT(SUBSTRING('{table}' FROM 1 FOR 4), '-', t.id) AS source_id,                                    -- Unique source_id created so no duplicates can happen in error
+                        t.name,
+                        '{table}' AS layer,
+                        t.district_id,
+                        t.district,
+                        t.neighborhood_id,
+                        t.neighborhood,
+                        ST_SetSRID(t.geometry, 4326) AS geometry,                                                             -- Metadata-only SRID stamp, no EWKT text round-trip (SRID checked in validation)
+                        (to_jsonb(t) - ARRAY['id', 'name', 'district_id', 'neighborhood_id', 'latitude', 'longitude', 'geometry']) AS attributes     -- All other columns as attributes in JSONB (one subtraction pass, not seven)
+                    FROM berlin_source_data.{table} t
+                ) q;
+            """))
+
+        if not args.rebuild:
+            conn.execute(text("""
+                INSERT INTO all_pois_stage                                                                                   -- Incremental runs enrich against the full POI universe, not just this run's delta,
+                    (poi_id, source_id, name, layer, district_id, district, neighborhood_id, neighborhood,                   -- so existing listings pick up newly loaded layers and new listings see old ones
+                     latitude, longitude, geometry, attributes)
+                SELECT u.poi_id, u.source_id, u.name, u.layer, u.district_id, u.district, u.neighborhood_id, u.neighborhood,
+                       u.latitude, u.longitude, u.geometry, u.attributes
+                FROM unified_pois u
+                WHERE NOT EXISTS (SELECT 1 FROM all_pois_stage s WHERE s.poi_id = u.poi_id);
+            """))
+
+        conn.execute(text("""
+            CREATE INDEX idx_all_pois_stage_geom ON all_pois_stage USING GIST (geometry);                                    -- KNN (<->) needs a GiST index, which a CTE can never have
+            CREATE INDEX idx_all_pois_stage_layer ON all_pois_stage (layer);
+            CLUSTER all_pois_stage USING idx_all_pois_stage_geom;                                                            -- Physically order rows for spatial locality
+            ANALYZE all_pois_stage;                                                                                          -- Give the planner fresh stats before the enrichment query
+        """))
+
+        enrich_sql = """
+            WITH candidate_pois AS (                                                                                              -- Flat (listing, layer, candidate) set from one incremental KNN descent per listing
+                SELECT
+                    ap.poi_id AS listing_id,
+                    p.poi_id,
+                    p.name,
+                    p.layer,
+                    ST_Distance(ap.geometry, p.geometry) AS distance,
+                    p.attributes->>'street' AS street,
+                    p.attributes->>'housenumber' AS housenumber,
+                    ROW_NUMBER() OVER (PARTITION BY ap.poi_id, p.layer
+                                       ORDER BY ST_Distance(ap.geometry, p.geometry)) AS rn                                       -- Rank candidates per layer in the same single sort
+                FROM all_pois_stage ap
+                CROSS JOIN LATERAL (
+                    SELECT p.poi_id, p.name, p.layer, p.geometry, p.attributes
+                    FROM all_pois_stage p
+                    WHERE p.layer <> 'long_term_listings'                                                                         -- Won't add the listing itself to the nearest_pois json doc
+                    ORDER BY p.geometry <-> ap.geometry
+                    LIMIT 50                                                                                                      -- Cheap because <-> is incremental; must stay >= expected POIs of one layer crowding a spot
+                ) p
+                WHERE ap.layer = 'long_term_listings'                                                                             -- Only add nearest pois for long_term_listings layer
             ),
-            pois_with_nearest AS ( 
-                SELECT 
-                    ap.poi_id,
-                    ap.name,
-                    ap.layer,
-                    ap.district_id,
-                    ap.district,
-                    ap.neighborhood_id,
-                    ap.neighborhood,
-                    ap.latitude,
-                    ap.longitude,
-                    ap.geometry,
-                    ap.attributes,
-                (
-                    SELECT jsonb_object_agg(layername, nearestinfo)                                                               -- Create jsonb object for nearest pois to the listing
-                    FROM (
-                        SELECT 
-                            ul.layer AS layername,
-                            (
-                                SELECT jsonb_build_object(
-                                    'id', p.poi_id,
-                                    'name', p.name,
-                                    'distance', ST_Distance(ap.geometry, p.geometry),
-                                    'address', jsonb_build_object(
-                                        'street', p.attributes->>'street',
-                                        'housenumber', p.attributes->>'housenumber'
-                                    )
-                                )
-                                FROM all_pois p
-                                WHERE p.layer = ul.layer 
-                                ORDER BY ap.geometry <-> p.geometry
-                                LIMIT 1
-                            ) AS nearestinfo
-                        FROM unique_layers ul
-                        WHERE ap.layer = 'long_term_listings' AND ul.layer <> 'long_term_listings'                                -- Only add nearest pois for long_term_listings layer
-                    ) AS layer_nearest
-                ) AS nearest_pois
-            FROM all_pois ap
+            listing_nearest AS (
+                SELECT
+                    listing_id AS poi_id,
+                    jsonb_object_agg(layer, jsonb_build_object(                                                                   -- Create jsonb object for nearest pois to the listing, built only for the winners
+                        'id', poi_id,
+                        'name', name,
+                        'distance', distance,
+                        'address', jsonb_build_object('street', street, 'housenumber', housenumber)
+                    )) AS nearest_pois
+                FROM candidate_pois
+                WHERE rn = 1
+                GROUP BY listing_id
         )
-        INSERT INTO unified_pois 
-            (poi_id, name, layer, district_id, district, neighborhood_id, neighborhood, 
-             latitude, longitude, geometry, attributes, nearest_pois)
-        SELECT 
-            poi_id, name, layer, district_id, district, neighborhood_id, neighborhood,
-            latitude, longitude, geometry, attributes, nearest_pois
-        FROM pois_with_nearest;
+        UPDATE all_pois_stage s                                                                                                   -- Enrich the staging table in place, non-listing rows keep NULL
+        SET nearest_pois = ln.nearest_pois
+        FROM listing_nearest ln
+        WHERE s.poi_id = ln.poi_id;
     """
-    
-    conn.execute(text(insert_sql))
+
+        if use_python_knn:
+            # Pull coordinates into contiguous NumPy arrays and answer every (listing, layer) pair with one vectorized KD-tree query per layer
+            pois = pd.read_sql(text("""
+                SELECT poi_id, name, layer,
+                    longitude AS lon, latitude AS lat,                                                                        -- Already derived (via centroid) during staging, works for non-point layers too
+                    attributes->>'street' AS street, attributes->>'housenumber' AS housenumber
+                FROM all_pois_stage;
+            """), conn)
+            pois = pois[pois['lon'].notna() & pois['lat'].notna()]                                                            # NULL geometry passes validation; such listings keep NULL nearest_pois and such POIs can't be neighbours, matching the SQL path
+            listings = pois[pois['layer'] == 'long_term_listings']
+            listing_xy = np.column_stack([listings['lon'].astype(float), listings['lat'].astype(float)])
+            nearest_docs = {listing_id: {} for listing_id in listings['poi_id']}
+
+            if len(listing_xy):
+                for layer_name, layer_pois in pois[pois['layer'] != 'long_term_listings'].groupby('layer'):                       # Won't add the listing itself to the nearest_pois json doc
+                    layer_pois = layer_pois.reset_index(drop=True)
+                    tree = cKDTree(np.column_stack([layer_pois['lon'].astype(float), layer_pois['lat'].astype(float)]))
+                    dist, idx = tree.query(listing_xy, k=1)                                                                       # One call answers every listing for this layer
+                    for listing_id, d, i in zip(listings['poi_id'], dist, idx):
+                        nearest = layer_pois.iloc[i]
+                        nearest_docs[listing_id][layer_name] = {
+                            'id': int(nearest['poi_id']),
+                            'name': nearest['name'],
+                            'distance': float(d),                                                                                 # Planar degree distance, same as ST_Distance on SRID 4326
+                            'address': {'street': nearest['street'], 'housenumber': nearest['housenumber']},
+                        }
+
+            payload = io.StringIO()                                                                                               # Stream the jsonb docs back in one COPY instead of row-wise UPDATEs
+            for listing_id, doc in nearest_docs.items():
+                if not doc:
+                    continue                                                                                                      # Listing with no neighbours keeps NULL nearest_pois, like the SQL path, not '{}'
+                payload.write(str(listing_id) + '\t' + json.dumps(doc).replace('\\', '\\\\') + '\n')
+            payload.seek(0)
+
+            copy_cur = conn.connection.cursor()
+            copy_cur.execute("CREATE TEMP TABLE listing_nearest_stage (poi_id BIGINT, nearest_pois JSONB) ON COMMIT DROP;")
+            copy_cur.copy_expert("COPY listing_nearest_stage FROM STDIN", payload)
+            copy_cur.close()
+
+            enrich_sql = """
+                UPDATE all_pois_stage s                                                                                           -- Enrich the staging table in place, non-listing rows keep NULL
+                SET nearest_pois = ln.nearest_pois
+                FROM listing_nearest_stage ln
+                WHERE s.poi_id = ln.poi_id;
+            """
+            enrich_statement = 'knn_update'
+        else:
+            enrich_statement = 'enrich_sql'
+
+        run_id = str(uuid.uuid4())
+        plan = conn.execute(text("EXPLAIN (FORMAT JSON) " + enrich_sql)).scalar()                                                 # Plan-only capture; swap in ANALYZE, BUFFERS for a timed dry run (BUFFERS alone needs PG 13+)
+        conn.execute(text("""
+            INSERT INTO public.query_plans (run_id, statement, plan)                                                              -- shared_hit_blocks vs actual_total_time tells memory-bound from compute-bound
+            VALUES (:run_id, :statement, CAST(:plan AS jsonb));
+        """), {"run_id": run_id, "statement": enrich_statement, "plan": json.dumps(plan)})
+
+        conn.execute(text(enrich_sql))
+
+        if args.rebuild:
+            conn.execute(text("""
+                ALTER TABLE unified_pois DROP CONSTRAINT IF EXISTS unified_pois_pkey;                                                 -- No per-row uniqueness check while bulk loading from empty
+            """))
+
+            conn.execute(text("""
+                INSERT INTO unified_pois                                                                                              -- Final write is a plain bulk INSERT ... SELECT from the enriched stage
+                    (poi_id, source_id, name, layer, district_id, district, neighborhood_id, neighborhood,
+                     latitude, longitude, geometry, attributes, nearest_pois)
+                SELECT
+                    poi_id, source_id, name, layer, district_id, district, neighborhood_id, neighborhood,
+                    latitude, longitude, geometry, attributes, nearest_pois
+                FROM all_pois_stage;
+            """))
+
+            conn.execute(text("""
+                ALTER TABLE unified_pois ADD PRIMARY KEY (poi_id) WITH (FILLFACTOR = 100);                                            -- Rebuild PK in one pass, packed tight since table is load-only
+            """))
+        else:
+            conn.execute(text("""
+                INSERT INTO unified_pois                                                                                              -- Incremental runs upsert the delta on the existing PK
+                    (poi_id, source_id, name, layer, district_id, district, neighborhood_id, neighborhood,
+                     latitude, longitude, geometry, attributes, nearest_pois)
+                SELECT
+                    poi_id, source_id, name, layer, district_id, district, neighborhood_id, neighborhood,
+                    latitude, longitude, geometry, attributes, nearest_pois
+                FROM all_pois_stage
+                ON CONFLICT (poi_id) DO UPDATE SET
+                    source_id = EXCLUDED.source_id,
+                    name = EXCLUDED.name,
+                    layer = EXCLUDED.layer,
+                    district_id = EXCLUDED.district_id,
+                    district = EXCLUDED.district,
+                    neighborhood_id = EXCLUDED.neighborhood_id,
+                    neighborhood = EXCLUDED.neighborhood,
+                    latitude = EXCLUDED.latitude,
+                    longitude = EXCLUDED.longitude,
+                    geometry = EXCLUDED.geometry,
+                    attributes = EXCLUDED.attributes,
+                    nearest_pois = EXCLUDED.nearest_pois;
+            """))
+
+        conn.execute(text("""
+                INSERT INTO public.processed_tables_log (table_name)                                                                    -- Create a list of tables that have been processed
+                SELECT unnest(CAST(:names AS text[])) ON CONFLICT DO NOTHING;
+            """), {"names": new_tables})
 
     for table in new_tables:
-        conn.execute(text(f"""
-            INSERT INTO public.processed_tables_log (table_name)                                                                    -- Create a list of tables that have been processed
-            VALUES ('{table}') ON CONFLICT DO NOTHING;
-        """))
-                    
         print(f"✅ Adding {table} to unified_pois.")
     else:
         print(f"✅ Insert complete.")
@@ -280,5 +434,19 @@ with engine.begin() as conn:
         CREATE INDEX IF NOT EXISTS idx_poi_geom ON unified_pois                                                                   -- Create an INDEX so queries run faster on GIST
         USING GIST (geometry);
     """))
-        
+
+    conn.execute(text("""
+        CREATE INDEX IF NOT EXISTS idx_poi_attrs_gin ON unified_pois                                                              -- GIN indexes so downstream jsonb containment queries don't seq-scan
+        USING GIN (attributes jsonb_path_ops);
+        CREATE INDEX IF NOT EXISTS idx_poi_nearest_gin ON unified_pois
+        USING GIN (nearest_pois jsonb_path_ops);
+        CREATE INDEX IF NOT EXISTS idx_poi_source_id ON unified_pois (source_id);                                                 -- For joining back to the source tables by textual id
+    """))
+
+    conn.execute(text("""
+        CREATE STATISTICS IF NOT EXISTS stats_poi_layer_district (dependencies, ndistinct)                                        -- Extended stats so the planner knows layer/district/neighborhood are correlated
+            ON layer, district_id, neighborhood_id FROM unified_pois;
+        ANALYZE unified_pois;                                                                                                     -- Fresh row counts and selectivities after the bulk load
+    """))
+
     print("✅Spatial index created.")